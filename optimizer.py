@@ -2,7 +2,72 @@ import numpy as np
 from prob import logistic_loss, l1_constraint, l2_constraint, n_supp_constraint
 
 
-def fw(x_init, n_iter, feature, label, constraint_type, R, lr_type):
+def _diff_products(x, grad_x, idx, val):
+    """
+    grad_x @ (x - v) and (x - v) @ (x - v) for a fw vertex v
+    with support idx and values val
+    """
+    if idx is None:
+        diff = x - val
+    else:
+        diff = x.copy()
+        diff[idx] -= val
+    return float(grad_x @ diff), float(diff @ diff)
+
+
+def _clip_lr(gd, curvature):
+    """
+    gd / curvature, i.e., the minimizer of the quadratic upper bound along v - x, clipped to [0, 1].
+    zero curvature means the bound is linear along v - x, so a full step is taken
+    """
+    if curvature <= 0:
+        return 1 if gd > 0 else 0
+    return max(0, min(gd / curvature, 1))
+
+
+def _lr_s(k, objective, x, grad_x, idx, val):
+    """
+    smooth step size, based on the Lipschitz constant of the loss
+    """
+    gd, dd = _diff_products(x, grad_x, idx, val)
+    if dd < 1e-30:
+        # x is (numerically) at v already, there is nothing to move
+        return 0, None
+    return _clip_lr(gd, objective.L * dd), None
+
+
+def _lr_ds(k, objective, x, grad_x, idx, val):
+    """
+    directionally smooth step size, based on the smoothness along v - x.
+    feature @ v is returned as well, so that it can be reused by the update
+    """
+    gd, dd = _diff_products(x, grad_x, idx, val)
+    if dd < 1e-30:
+        # x is (numerically) at v already, there is nothing to move
+        return 0, None
+    feature_v = objective.feature_dot(idx, val)
+    feature_diff = feature_v - objective.feature_x
+    # Lk * (x - v) @ (x - v), with Lk = \| feature @ (v - x) \|^2 / (4 * n_data * (x - v) @ (x - v))
+    return _clip_lr(gd, float(feature_diff @ feature_diff) / (4 * objective.n_data)), feature_v
+
+
+def _step_size_rule(lr_type, pf_lr):
+    """
+    pick the step size rule once before the loop, so that iterations do not compare strings.
+    the rule maps (k, objective, x, grad_x, idx, val) to the step size and
+    feature @ v, where the latter is None unless the rule had to compute it
+    
+    Args:
+        lr_type (str): 'pf', 's' or 'ds'
+        pf_lr (np.ndarray): parameter-free step sizes, precomputed for all iterations
+    """
+    if lr_type == 'pf':
+        pf_lr = pf_lr.tolist()
+        return lambda k, objective, x, grad_x, idx, val: (pf_lr[k], None)
+    return _lr_s if lr_type == 's' else _lr_ds
+
+
+def fw(x_init, n_iter, feature, label, constraint_type, R, lr_type, dtype=np.float64, backend='numpy', log_every=1):
     """
     vanilla fw
     
@@ -15,9 +80,13 @@ def fw(x_init, n_iter, feature, label, constraint_type, R, lr_type):
         R: radius of constraint set, i.e., \| x \| <= R
         lr_type (str): what step size to use. It should be chosen from 'pf', 's', and 'ds',
                  which stand for parameter-free, smooth, and directionally smooth, respectively.
+        dtype: floating point type used to store the features. np.float32 is faster, but less accurate.
+        backend (str): 'numpy', or 'cupy' to run on the gpu.
+        log_every (int): f(x) is only evaluated every log_every iterations (and at the end),
+                 in between loss repeats the last evaluated value.
                  
     Returns:
-        loss (list): objective value of f(x) from iteration 0 to n_iter-1
+        loss (np.ndarray): objective value of f(x) from iteration 0 to n_iter-1
     """
     
     [n_data, dim] = feature.shape
@@ -25,6 +94,8 @@ def fw(x_init, n_iter, feature, label, constraint_type, R, lr_type):
     lr_type = lr_type.lower()
     if lr_type not in ['pf', 's', 'ds']:
         raise ValueError('Unsupported learning rate. Currently only pf, s, and, ds are valid choices.')
+    if log_every < 1:
+        raise ValueError('log_every should be a positive integer.')
         
     constraint_type = constraint_type.lower()
     if constraint_type == 'l1':
@@ -39,38 +110,39 @@ def fw(x_init, n_iter, feature, label, constraint_type, R, lr_type):
     
     
     # initialization
-    x = x_init
-    objective = logistic_loss(feature, label)
-    loss = [0 for i in range(n_iter+1)]
-    loss[0] = objective.function_value(x)
+    objective = logistic_loss(feature, label, dtype, backend)
+    x = objective.xp.array(x_init, dtype=float).reshape(-1,)
+    loss = np.empty(n_iter+1)
+    step_size = _step_size_rule(lr_type, 2 / (np.arange(n_iter) + 2))
+    # feature @ x is computed from scratch only here, and then tracked by objective.step
+    objective.set_x(x)
     
     for k in range(n_iter):
-        # step 1: gradient calculation
-        grad_x = objective.grad(x)
+        # step 1: gradient calculation from the tracked feature @ x, and loss every log_every iterations
+        log = k % log_every == 0
+        loss_x, grad_x = objective.value_and_grad(x, log)
+        loss[k] = loss_x if log else loss[k-1]
         
         # step 2: solve the fw subproblem
-        v = constraint.fw_subprob(grad_x)
+        idx, val = constraint.fw_subprob(grad_x)
         
         # step 3: determine the step size
-        if lr_type == 'pf':
-            lr = 2 / (k + 2)
-        elif lr_type == 's':
-            lr = (grad_x.T @ (x - v)) / (objective.L * (x - v).T @ (x - v))
-            lr = np.amin([lr, 1])
-        elif lr_type == 'ds':
-            Lk = np.linalg.norm(feature @(v - x))**2 / (4 * n_data * (x - v).T @ (x-v))        
-            lr = (grad_x.T @ (x - v)) / (Lk * (x - v).T @ (x - v))
-            lr = np.amin([lr, 1])
+        lr, feature_v = step_size(k, objective, x, grad_x, idx, val)
+        if lr == 0:
+            # x stays put, and vanilla fw would repeat this very iteration from now on
+            loss[k+1:] = objective.function_value(x, objective.feature_x)
+            return loss
             
-        # step 4: update
-        x = (1 - lr) * x + lr * v
-        loss[k+1] = objective.function_value(x)
+        # step 4: update x and feature @ x in place
+        objective.step(x, lr, idx, val, feature_v)
+    
+    loss[n_iter] = objective.function_value(x, objective.feature_x)
     
     return loss
 
 
 
-def wfw(x_init, n_iter, feature, label, constraint_type, R, lr_type):
+def wfw(x_init, n_iter, feature, label, constraint_type, R, lr_type, dtype=np.float64, backend='numpy', log_every=1):
     """
     WFW: HFW with \delta = 2/(k+2)
     
@@ -83,9 +155,13 @@ def wfw(x_init, n_iter, feature, label, constraint_type, R, lr_type):
         R: radius of constraint set, i.e., \| x \| <= R
         lr_type (str): what step size to use. It should be chosen from 'pf', 's', and 'ds',
                  which stand for parameter-free, smooth, and directionally smooth, respectively.
+        dtype: floating point type used to store the features. np.float32 is faster, but less accurate.
+        backend (str): 'numpy', or 'cupy' to run on the gpu.
+        log_every (int): f(x) is only evaluated every log_every iterations (and at the end),
+                 in between loss repeats the last evaluated value.
     
     Returns:
-        loss (list): objective value of f(x) from iteration 0 to n_iter-1
+        loss (np.ndarray): objective value of f(x) from iteration 0 to n_iter-1
     """
     
     [n_data, dim] = feature.shape
@@ -93,6 +169,8 @@ def wfw(x_init, n_iter, feature, label, constraint_type, R, lr_type):
     lr_type = lr_type.lower()
     if lr_type not in ['pf', 's', 'ds']:
         raise ValueError('Unsupported learning rate. Currently only pf, s, and, ds are valid choices.')
+    if log_every < 1:
+        raise ValueError('log_every should be a positive integer.')
         
     constraint_type = constraint_type.lower()
     if constraint_type == 'l1':
@@ -106,44 +184,43 @@ def wfw(x_init, n_iter, feature, label, constraint_type, R, lr_type):
         raise ValueError('Unsupported constraint set. Currently only l1, l2, and, n_supp norm balls are valid choices.')
     
     # initialization
-    x = x_init
+    objective = logistic_loss(feature, label, dtype, backend)
+    x = objective.xp.array(x_init, dtype=float).reshape(-1,)
     # here we use a lazy approach to initialize g, since we have \delta_0 = 1
-    g = np.zeros((dim,1))   
-    objective = logistic_loss(feature, label)
-    loss = [0 for i in range(n_iter+1)]
-    loss[0] = objective.function_value(x)
+    g = objective.xp.zeros(dim)
+    loss = np.empty(n_iter+1)
+    step_size = _step_size_rule(lr_type, 2 / (np.arange(n_iter) + 2))
+    # feature @ x is computed from scratch only here, and then tracked by objective.step
+    objective.set_x(x)
     
     for k in range(n_iter):
-        # step 1: gradient calculation
-        grad_x = objective.grad(x)
+        # step 1: gradient calculation from the tracked feature @ x, and loss every log_every iterations
+        log = k % log_every == 0
+        loss_x, grad_x = objective.value_and_grad(x, log)
+        loss[k] = loss_x if log else loss[k-1]
         
-        # step 2: update heavy ball momentum 
+        # step 2: update heavy ball momentum in place
         delta = 2/(k+2)
-        g = delta * grad_x + (1 - delta) * g
+        g *= 1 - delta
+        g += delta * grad_x
         
         # step 3: solve the fw subproblem
-        v = constraint.fw_subprob(g)
+        idx, val = constraint.fw_subprob(g)
             
-        # step 4: determine step size
-        if lr_type == 'pf':
-            lr = 2 / (k + 2)
-        elif lr_type == 's':
-            lr = (grad_x.T @ (x - v)) / (objective.L * (x - v).T @ (x - v))
-            lr = np.amax([0, np.amin([lr, 1])])
-        elif lr_type == 'ds':
-            Lk = np.linalg.norm(feature @ (v - x))**2 / (4 * n_data * (x - v).T @ (x-v))
-            lr = (grad_x.T @ (x - v)) / (Lk * (x - v).T @ (x - v))
-            lr = np.amax([0, np.amin([lr, 1])]) 
+        # step 4: determine the step size
+        lr, feature_v = step_size(k, objective, x, grad_x, idx, val)
         
-        # step 5: update
-        x = (1 - lr)*x + lr * v        
-        loss[k+1] = objective.function_value(x)
+        # step 5: update x and feature @ x in place, unless x does not move
+        if lr > 0:
+            objective.step(x, lr, idx, val, feature_v)
+    
+    loss[n_iter] = objective.function_value(x, objective.feature_x)
     
     return loss
 
 
 
-def ufw(x_init, n_iter, feature, label, constraint_type, R, lr_type):
+def ufw(x_init, n_iter, feature, label, constraint_type, R, lr_type, dtype=np.float64, backend='numpy', log_every=1):
     """
     UFW: HFW with \delta = 1/(k+1)
     
@@ -156,9 +233,13 @@ def ufw(x_init, n_iter, feature, label, constraint_type, R, lr_type):
         R: radius of constraint set, i.e., \| x \| <= R
         lr_type (str): what step size to use. It should be chosen from 'pf', 's', and 'ds',
                  which stand for parameter-free, smooth, and directionally smooth, respectively.
+        dtype: floating point type used to store the features. np.float32 is faster, but less accurate.
+        backend (str): 'numpy', or 'cupy' to run on the gpu.
+        log_every (int): f(x) is only evaluated every log_every iterations (and at the end),
+                 in between loss repeats the last evaluated value.
     
     Returns:
-        loss (list): objective value of f(x) from iteration 0 to n_iter-1
+        loss (np.ndarray): objective value of f(x) from iteration 0 to n_iter-1
     """
     
     [n_data, dim] = feature.shape
@@ -166,6 +247,8 @@ def ufw(x_init, n_iter, feature, label, constraint_type, R, lr_type):
     lr_type = lr_type.lower()
     if lr_type not in ['pf', 's', 'ds']:
         raise ValueError('Unsupported learning rate. Currently only pf, s, and, ds are valid choices.')
+    if log_every < 1:
+        raise ValueError('log_every should be a positive integer.')
         
     constraint_type = constraint_type.lower()
     if constraint_type == 'l1':
@@ -179,37 +262,36 @@ def ufw(x_init, n_iter, feature, label, constraint_type, R, lr_type):
         raise ValueError('Unsupported constraint set. Currently only l1, l2, and, n_supp norm balls are valid choices.')
     
     # initialization
-    x = x_init
+    objective = logistic_loss(feature, label, dtype, backend)
+    x = objective.xp.array(x_init, dtype=float).reshape(-1,)
     # here we use a lazy approach to initialize g, since we have \delta_0 = 1
-    g = np.zeros((dim,1))   
-    objective = logistic_loss(feature, label)
-    loss = [0 for i in range(n_iter+1)]
-    loss[0] = objective.function_value(x)
+    g = objective.xp.zeros(dim)
+    loss = np.empty(n_iter+1)
+    step_size = _step_size_rule(lr_type, 1 / (np.arange(n_iter) + 1))
+    # feature @ x is computed from scratch only here, and then tracked by objective.step
+    objective.set_x(x)
     
     for k in range(n_iter):
-        # step 1: gradient calculation
-        grad_x = objective.grad(x)
+        # step 1: gradient calculation from the tracked feature @ x, and loss every log_every iterations
+        log = k % log_every == 0
+        loss_x, grad_x = objective.value_and_grad(x, log)
+        loss[k] = loss_x if log else loss[k-1]
         
-        # step 2: update heavy ball momentum 
+        # step 2: update heavy ball momentum in place
         delta = 1 / (k + 1)
-        g = delta * grad_x + (1 - delta) * g
+        g *= 1 - delta
+        g += delta * grad_x
         
         # step 3: solve the fw subproblem
-        v = constraint.fw_subprob(g)
+        idx, val = constraint.fw_subprob(g)
             
-        # step 4: determine step size
-        if lr_type == 'pf':
-            lr = 1 / (k + 1)
-        elif lr_type == 's':
-            lr = (grad_x.T @ (x - v)) / (objective.L * (x - v).T @ (x - v))
-            lr = np.amax([0, np.amin([lr, 1])])
-        elif lr_type == 'ds':
-            Lk = np.linalg.norm(feature @ (v - x))**2 / (4 * n_data * (x - v).T @ (x-v))
-            lr = (grad_x.T @ (x - v)) / (Lk * (x - v).T @ (x - v))
-            lr = np.amax([0, np.amin([lr, 1])]) 
+        # step 4: determine the step size
+        lr, feature_v = step_size(k, objective, x, grad_x, idx, val)
         
-        # step 5: update
-        x = (1 - lr)*x + lr * v        
-        loss[k+1] = objective.function_value(x)
+        # step 5: update x and feature @ x in place, unless x does not move
+        if lr > 0:
+            objective.step(x, lr, idx, val, feature_v)
+    
+    loss[n_iter] = objective.function_value(x, objective.feature_x)
     
     return loss
@@ -1,30 +1,192 @@
+import math
+import operator
 import numpy as np
+from scipy.special import expit
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+try:
+    import cupy as cp
+    import cupyx.scipy.sparse
+    import cupyx.scipy.special
+except ImportError:
+    cp = None
+try:
+    from sparse_dot_mkl import dot_product_mkl
+except ImportError:
+    dot_product_mkl = None
+
+
+def _spmv(A, x):
+    """
+    sparse matrix-vector product A @ x
+    """
+    return A @ x
+
+
+if dot_product_mkl is not None:
+    # MKL's SpMV is multi-threaded, unlike scipy's
+    def _spmv(A, x):
+        return dot_product_mkl(A, x, cast=True)
+
+
+def _logistic_vg(feature_x, label, w, with_loss=True):
+    """
+    logistic loss summed over the data, together with the weights w
+    such that the gradient is feature.T @ w / n_data
+    feature_x and label are 1-d arrays, and w is filled in place
+    with_loss=False skips the loss, which is then returned as 0
+    """
+    # w holds label * feature_x first, and then (sigmoid(label * feature_x) - 1) * label.
+    # logaddexp and expit do not overflow for large margins
+    np.multiply(feature_x, label, out=w)
+    loss = np.logaddexp(0, - w).sum() if with_loss else 0.0
+    expit(w, out=w)
+    w -= 1
+    w *= label
+    return loss, w
+
+
+if njit is not None:
+    # with numba, the same quantities are computed in a single fused pass over the data
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _logistic_vg(feature_x, label, w, with_loss=True):
+        n_data = feature_x.shape[0]
+        loss = 0.0
+        for i in prange(n_data):
+            margin = - label[i] * feature_x[i]
+            # stable log(1 + exp(margin)) and 1 / (1 + exp(margin))
+            if margin > 0:
+                e = np.exp(- margin)
+                if with_loss:
+                    loss += margin + np.log1p(e)
+                sig = e / (1.0 + e)
+            else:
+                e = np.exp(margin)
+                if with_loss:
+                    loss += np.log1p(e)
+                sig = 1.0 / (1.0 + e)
+            w[i] = (sig - 1.0) * label[i]
+        return loss, w
+
+
+if cp is not None:
+    def _logistic_vg_cupy(feature_x, label, w, with_loss=True):
+        """
+        gpu version of _logistic_vg, for cupy arrays
+        """
+        cp.multiply(feature_x, label, out=w)
+        loss = cp.logaddexp(0, - w).sum() if with_loss else 0.0
+        cupyx.scipy.special.expit(w, out=w)
+        w -= 1
+        w *= label
+        return loss, w
+
 
 class logistic_loss():
-    def __init__(self, feature, label):
-        self.feature = feature
-        self.label = label
+    def __init__(self, feature, label, dtype=np.float64, backend='numpy'):
+        # csr suits feature @ x, and its transpose is precomputed (again as csr) once, for
+        # the gradient and for extracting the columns touched by a sparse fw vertex.
+        # dtype=np.float32 halves the memory traffic of the gradient SpMV.
+        self.feature = feature.tocsr().astype(dtype)
+        self.featureT = self.feature.T.tocsr()
+        # 1-d float labels avoid broadcasting against (n_data, 1) intermediates
+        self.label = np.ascontiguousarray(label, dtype=np.float64).reshape(-1,)
         [n_data, dim] = feature.shape
         self.n_data = n_data
         self.dim = dim
         # Lipschitz constant, which might be useful for smooth step size
         self.L = np.sum(feature.power(2))/(4*n_data) 
+        
+        # with backend 'cupy', feature and label are moved to the gpu once, and x is expected
+        # to live there too (created with self.xp), so that only scalars come back to the host
+        backend = backend.lower()
+        if backend == 'numpy':
+            self.xp = np
+            self._spmv = _spmv
+            self._logistic_vg = _logistic_vg
+        elif backend == 'cupy':
+            if cp is None:
+                raise ImportError('The cupy backend requires cupy to be installed.')
+            self.xp = cp
+            self.feature = cupyx.scipy.sparse.csr_matrix(self.feature)
+            self.featureT = cupyx.scipy.sparse.csr_matrix(self.featureT)
+            self.label = cp.asarray(self.label)
+            self._spmv = operator.matmul
+            self._logistic_vg = _logistic_vg_cupy
+        else:
+            raise ValueError('Unsupported backend. Currently only numpy and cupy are valid choices.')
+        
+        # buffer for the per-sample gradient weights, reused by every evaluation
+        self._w = self.xp.empty(n_data, dtype=dtype)
+
+    def _value_and_weights(self, feature_x, with_value=True):
+        """
+        logistic loss (None if with_value=False) and gradient weights
+        from feature @ x, such that the gradient is feature.T @ w / n_data
+        """
+        obj_val, w = self._logistic_vg(feature_x, self.label, self._w, with_value)
+        return (float(obj_val) / self.n_data if with_value else None), w
 
     def grad(self, x):
         """
         calculate gradient of logistic loss at x
         """
-        tmp = - np.multiply(self.feature @ x, self.label)
-        tmp = 1 - np.divide(1, 1 + np.exp(tmp))
-        tmp = - np.multiply( tmp,  self.label)
-        return self.feature.T @ tmp / self.n_data
+        _, tmp = self._value_and_weights(self._spmv(self.feature, x.reshape(-1,)), False)
+        return self._spmv(self.featureT, tmp).reshape(x.shape) / self.n_data
+
+    def set_x(self, x):
+        """
+        start tracking feature @ x at x,
+        which is the only time it is computed from scratch
+        """
+        self.feature_x = self._spmv(self.feature, x)
+
+    def value_and_grad(self, x, with_value=True):
+        """
+        compute logistic loss and its gradient at x,
+        reading the tracked feature @ x. x should be the 1-d point
+        passed to set_x and moved by step since then.
+        with_value=False skips the loss, which is then returned as None
+        """
+        obj_val, tmp = self._value_and_weights(self.feature_x, with_value)
+        return obj_val, self._spmv(self.featureT, tmp) / self.n_data
+
+    def step(self, x, lr, idx, val, feature_v=None):
+        """
+        move x to (1 - lr) * x + lr * v in place, for a fw vertex v
+        with support idx and values val, and update feature @ x with it.
+        feature_v can be passed in if feature @ v is already known
+        """
+        if feature_v is None:
+            feature_v = self.feature_dot(idx, val)
+        x *= 1 - lr
+        if idx is None:
+            x += lr * val
+        else:
+            x[idx] += lr * val
+        self.feature_x *= 1 - lr
+        self.feature_x += lr * feature_v
+
+    def feature_dot(self, idx, val):
+        """
+        compute feature @ v for a fw vertex v with support idx and values val,
+        where idx = None means v is dense
+        """
+        if idx is None:
+            return self._spmv(self.feature, val)
+        return self.featureT[idx].T @ val
 
-    def function_value(self, x):
+    def function_value(self, x, feature_x=None):
         """
         compute logistic loss
+        feature_x can be passed in if feature @ x is already known
         """
-        obj_val = np.sum(np.log(1 + np.exp(-self.label * (self.feature.dot(x))))) / self.n_data
-        return obj_val.reshape(-1,)
+        if feature_x is None:
+            feature_x = self._spmv(self.feature, x.reshape(-1,))
+        obj_val, _ = self._value_and_weights(feature_x)
+        return obj_val
 
 
 
@@ -36,23 +198,28 @@ class l1_constraint():
         """
         fw subproblem for 
         l1 norm ball constraint
+        v is 1-sparse, so only its support and values are returned
         """
-        idx = np.argmax(np.abs(grad))
-        v = np.zeros(grad.shape)
-        v[idx] = - np.sign(grad[idx]) * self.R    
-        return  v
+        idx = np.atleast_1d(np.argmax(np.abs(grad)))
+        return idx, - np.sign(grad[idx]) * self.R
 
 
 class l2_constraint():
     def __init__(self, R):
         self.R = R
+        # buffer for v, overwritten by every call of fw_subprob
+        self._v = None
         
     def fw_subprob(self, grad):
         """
         fw subproblem for 
         l2 norm ball constraint
+        v is dense, which is marked by an empty support
         """
-        return - grad * self.R / np.linalg.norm(grad)
+        if self._v is None or self._v.shape != grad.shape:
+            self._v = np.empty_like(grad)
+        g = grad.reshape(-1,)
+        return None, np.multiply(grad, - self.R / math.sqrt(g @ g), out=self._v)
 
 
 class n_supp_constraint():
@@ -66,9 +233,8 @@ class n_supp_constraint():
         fw subproblem for 
         n-support norm ball constraint
         we implicitly use n=2 in our experiements.
+        v is n-sparse, so only its support and values are returned
         """
-        sorted_idx = np.argsort(np.abs(grad).reshape(-1,))
-        top_n = sorted_idx[self.dim-self.n-1 : self.dim-1]
-        trunc_grad = np.zeros(grad.shape)
-        trunc_grad[top_n] = grad[top_n]
-        return - trunc_grad * self.R / np.linalg.norm(trunc_grad)
+        # only the n largest entries of |grad| are needed, no need to sort all of them
+        top_n = np.argpartition(np.abs(grad).reshape(-1,), -self.n)[-self.n:]
+        return top_n, - grad[top_n] * self.R / np.linalg.norm(grad[top_n])